@@ -0,0 +1,177 @@
+"""
+Cancellation of streamed agent runs whose client has gone away.
+
+Under ASGI, Django cancels the task sending a streaming response when the
+client disconnects, and the WebSocket endpoint cancels its turn task the same
+way. `stream_turn_frames` catches that (`CancelledError`, or `GeneratorExit`
+when the stream is closed at a `yield`) around its event loop and hands the
+run to `RunGuard.client_disconnected`. The SDK's `stream_events()` swallows a
+cancellation that lands inside it and simply ends the stream, so the view also
+checks `reader_cancelled()` once the events run out. Nothing here adds work per
+event.
+
+- With no grace period (the default) the run is cancelled at once. The
+  cancellation reaches the run task and whatever it is awaiting, including the
+  gpt-4.1 request of `analyze_property_image_tool`, whose connection is closed.
+- With `CHAT_DISCONNECT_GRACE_SECONDS` > 0 the events are read by a task of
+  their own (`DetachedEvents`), so the run keeps being consumed after the
+  client left. If it completes within the grace period the turn is persisted
+  as if it had been delivered (continuation handle, WebSocket history);
+  otherwise it is cancelled.
+
+Counters: `stream.aborted` (and per agent), `stream.completed_in_grace`, and
+`stream.tokens_saved`, an estimate of the output tokens not generated: the mean
+output tokens of the agent's completed runs minus what the aborted run had
+already produced: its reported usage, or if larger (usage only arrives with a
+finished response) the delta text the client received, at about
+`CHARS_PER_TOKEN` characters per token.
+"""
+import asyncio
+import logging
+from typing import Any, AsyncIterator, Callable, Optional, Set
+
+from django.conf import settings
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+_END = object()
+# Rough characters per token of English model output
+CHARS_PER_TOKEN = 4
+# Strong references to grace-period tasks; the event loop only keeps weak ones
+_grace_tasks: Set[asyncio.Task] = set()
+
+
+def disconnect_grace_seconds() -> float:
+    return float(getattr(settings, "CHAT_DISCONNECT_GRACE_SECONDS", 0))
+
+
+def reader_cancelled() -> bool:
+    """True if the current task has a cancellation pending that something below swallowed."""
+    task = asyncio.current_task()
+    cancelling = getattr(task, "cancelling", None)  # Python 3.11+
+    return bool(cancelling and cancelling())
+
+
+def _output_tokens(result) -> int:
+    return sum(
+        getattr(getattr(response, "usage", None), "output_tokens", 0) or 0
+        for response in getattr(result, "raw_responses", None) or []
+    )
+
+
+def cancel_run(result) -> None:
+    """Stop a `Runner.run_streamed` result's run task and guardrail tasks."""
+    cancel = getattr(result, "cancel", None)
+    if callable(cancel):
+        cancel()
+        return
+    # openai-agents 0.0.10 has no public cancel(); this is what stream_events() does when it is cancelled
+    result._cleanup_tasks()
+    result.is_complete = True
+
+
+class DeliveredText:
+    """Characters of model output sent to the client; `sse_frames` adds to it."""
+
+    def __init__(self):
+        self.chars = 0
+
+    def tokens(self) -> int:
+        return -(-self.chars // CHARS_PER_TOKEN)
+
+
+class DetachedEvents:
+    """Reads `events` in a task of its own and hands them over through a queue."""
+
+    def __init__(self, events: AsyncIterator[Any]):
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.error: Optional[Exception] = None
+        self.task = asyncio.ensure_future(self._pump(events))
+
+    async def _pump(self, events: AsyncIterator[Any]) -> None:
+        # Never raises (apart from being cancelled), so nothing is left unretrieved
+        try:
+            async for event in events:
+                self.queue.put_nowait(event)
+        except Exception as e:
+            self.error = e
+        finally:
+            self.queue.put_nowait(_END)
+
+    async def events(self) -> AsyncIterator[Any]:
+        while True:
+            event = await self.queue.get()
+            if event is _END:
+                if self.error is not None:
+                    raise self.error
+                return
+            yield event
+
+
+class RunGuard:
+    """Decides what happens to a streamed run once its client is gone."""
+
+    def __init__(self, result, agent_name: str, detached: Optional[DetachedEvents] = None,
+                 on_complete: Optional[Callable[[], None]] = None):
+        self.result = result
+        self.agent_name = agent_name
+        self.detached = detached
+        self.on_complete = on_complete
+        self.grace = disconnect_grace_seconds()
+        self._disconnected = False
+
+    def finished(self) -> None:
+        """Call once the run completed; its output tokens feed the tokens-saved estimate."""
+        metrics.observe(f"run.output_tokens.{self.agent_name}", _output_tokens(self.result))
+
+    def client_disconnected(self, delivered_tokens: int) -> None:
+        """`delivered_tokens` is the estimated output tokens the client received before it left."""
+        if self._disconnected:
+            return
+        self._disconnected = True
+        if self.detached is not None and self.grace > 0:
+            try:
+                task = asyncio.ensure_future(self._finish_within_grace(delivered_tokens))
+            except RuntimeError:
+                # Closed outside the event loop: nothing can keep the run going
+                self.detached.task.cancel()
+                self._abort(delivered_tokens)
+                return
+            _grace_tasks.add(task)
+            task.add_done_callback(_grace_tasks.discard)
+            return
+        if not self.result.is_complete:
+            self._abort(delivered_tokens)
+
+    async def _finish_within_grace(self, delivered_tokens: int) -> None:
+        logger.info("Client of %s stream disconnected; letting the run continue for %.1fs", self.agent_name, self.grace)
+        done, _ = await asyncio.wait({self.detached.task}, timeout=self.grace)
+        if not done:
+            self.detached.task.cancel()
+            self._abort(delivered_tokens)
+            return
+        if self.detached.error is not None:
+            logger.info("%s run failed after its client disconnected: %s", self.agent_name, self.detached.error)
+            return
+        metrics.incr("stream.completed_in_grace")
+        self.finished()
+        if self.on_complete is not None:
+            try:
+                self.on_complete()
+            except Exception:
+                logger.exception("Failed to persist %s turn completed after disconnect", self.agent_name)
+
+    def _abort(self, delivered_tokens: int) -> None:
+        cancel_run(self.result)
+        generated = max(delivered_tokens, _output_tokens(self.result))
+        completed = metrics.samples(f"run.output_tokens.{self.agent_name}")
+        saved = max(0.0, sum(completed) / len(completed) - generated) if completed else 0.0
+        metrics.incr("stream.aborted")
+        metrics.incr(f"stream.aborted.{self.agent_name}")
+        metrics.incr("stream.tokens_saved", saved)
+        logger.info(
+            "Cancelled %s run after client disconnect (~%d output tokens sent, ~%d saved)",
+            self.agent_name, delivered_tokens, saved,
+        )
@@ -0,0 +1,178 @@
+"""
+Record/replay cassettes of agent `stream_events()` sequences.
+
+A cassette is a gzipped JSON-lines file: one header line, then one line per
+stream event with its offset (seconds since the run started). Raw response
+events keep their OpenAI event payload, run item events keep the item type,
+agent, raw item and tool output, tool delta events (see chat/tool_stream.py)
+keep their text, and agent updates keep the new agent's name; the full
+`response` objects attached to created/completed events are reduced to their
+id to keep files small.
+
+Replay turns each line back into an attribute-access object shaped like the
+SDK event, so it can be fed through `views.sse_frames` without network calls
+(see the `replay_cassette` management command).
+"""
+import asyncio
+import gzip
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from types import SimpleNamespace
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+CASSETTE_VERSION = 1
+
+
+def cassette_recording_enabled() -> bool:
+    return bool(getattr(settings, "CHAT_CASSETTE_DIR", None))
+
+
+# --- Recording ---
+def _dump(obj: Any) -> Any:
+    if hasattr(obj, "model_dump"):
+        data = obj.model_dump(mode="json", exclude_none=True)
+    elif isinstance(obj, dict):
+        data = dict(obj)
+    else:
+        return obj
+    response = data.get("response")
+    if isinstance(response, dict):
+        data["response"] = {"id": response.get("id")}
+    return data
+
+
+def _agent_name(agent: Any) -> Optional[str]:
+    return getattr(agent, "name", None) if agent is not None else None
+
+
+def serialize_event(event: Any) -> Dict[str, Any]:
+    record: Dict[str, Any] = {"type": event.type}
+    if event.type == "raw_response_event":
+        record["data"] = _dump(event.data)
+    elif event.type == "run_item_stream_event":
+        item = event.item
+        record["name"] = event.name
+        record["item"] = {
+            "type": getattr(item, "type", None),
+            "agent": {"name": _agent_name(getattr(item, "agent", None))},
+            "raw_item": _dump(getattr(item, "raw_item", None)),
+        }
+        if isinstance(getattr(item, "output", None), str):
+            record["item"]["output"] = item.output
+    elif event.type == "tool_delta_event":
+        record.update(delta=event.delta, tool_name=event.tool_name, agent_name=event.agent_name)
+    elif event.type == "agent_updated_stream_event":
+        record["new_agent"] = {"name": _agent_name(event.new_agent)}
+    else:
+        data = getattr(event, "data", None)
+        if data is not None:
+            record["data"] = _dump(data)
+    if getattr(event, "is_last", False):
+        record["is_last"] = True
+    return record
+
+
+def _new_cassette_path(agent_name: str) -> str:
+    directory = settings.CHAT_CASSETTE_DIR
+    os.makedirs(directory, exist_ok=True)
+    slug = "".join(ch if ch.isalnum() else "-" for ch in agent_name.lower()).strip("-")
+    return os.path.join(directory, f"{time.strftime('%Y%m%d-%H%M%S')}-{slug}-{uuid.uuid4().hex[:8]}.jsonl.gz")
+
+
+def _write_cassette(path: Optional[str], agent_name: str, header: Dict[str, Any], records: List[Dict[str, Any]]) -> None:
+    try:
+        path = path or _new_cassette_path(agent_name)
+        with gzip.open(path, "wt", encoding="utf-8") as fh:
+            fh.write(json.dumps(header) + "\n")
+            for record in records:
+                fh.write(json.dumps(record, separators=(",", ":")) + "\n")
+        logger.info("Recorded %d stream events to cassette %s", len(records), path)
+    except Exception:
+        logger.exception("Failed to write cassette for %s", agent_name)
+
+
+async def record_cassette(events: AsyncIterator[Any], agent_name: str, path: Optional[str] = None) -> AsyncIterator[Any]:
+    """
+    Pass `events` through unchanged while recording them. Records are kept in
+    memory and the file is compressed and written once the stream ends, on a
+    worker thread, so the live stream never waits on disk I/O.
+    """
+    header = {"version": CASSETTE_VERSION, "agent": agent_name, "recorded_at": time.time()}
+    records: List[Dict[str, Any]] = []
+    started = time.monotonic()
+    completed = False
+    try:
+        async for event in events:
+            try:
+                record = serialize_event(event)
+                record["t"] = round(time.monotonic() - started, 4)
+                records.append(record)
+            except Exception:
+                # Never let recording break the live stream
+                logger.exception("Failed to record stream event of type %s", getattr(event, "type", None))
+            yield event
+        completed = True
+    finally:
+        if completed:
+            await asyncio.to_thread(_write_cassette, path, agent_name, header, records)
+        else:
+            # Cancelled or failed: keep what was recorded without awaiting during unwinding
+            threading.Thread(
+                target=_write_cassette, args=(path, agent_name, header, records), name="cassette-writer", daemon=True,
+            ).start()
+
+
+# --- Replay ---
+def _to_namespace(value: Any) -> Any:
+    if isinstance(value, dict):
+        return SimpleNamespace(**{key: _to_namespace(val) for key, val in value.items()})
+    if isinstance(value, list):
+        return [_to_namespace(val) for val in value]
+    return value
+
+
+def load_cassette(path: str) -> Dict[str, Any]:
+    """Return `{"header": {...}, "events": [...]}` with events as raw dicts."""
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt", encoding="utf-8") as fh:
+        lines = [json.loads(line) for line in fh if line.strip()]
+    if not lines:
+        raise ValueError(f"Empty cassette: {path}")
+    header, events = lines[0], lines[1:]
+    if header.get("version") != CASSETTE_VERSION:
+        raise ValueError(f"Unsupported cassette version {header.get('version')!r} in {path}")
+    return {"header": header, "events": events}
+
+
+def cassette_events(records: List[Dict[str, Any]]) -> List[Any]:
+    """Build SDK-shaped event objects once, so replay loops only measure the view code."""
+    events = []
+    for record in records:
+        record = {key: val for key, val in record.items() if key != "t"}
+        if record["type"] == "error_event" and isinstance(record.get("data"), dict):
+            # The view reads error events with dict access
+            events.append(SimpleNamespace(type="error_event", data=record["data"]))
+            continue
+        events.append(_to_namespace(record))
+    return events
+
+
+async def replay_events(records: List[Dict[str, Any]], realtime: bool = False, speed: float = 1.0) -> AsyncIterator[Any]:
+    """Yield cassette events at full speed, or with their recorded spacing."""
+    events = cassette_events(records)
+    offsets: Iterator[float] = (record.get("t", 0.0) for record in records)
+    started = time.monotonic()
+    for event, offset in zip(events, offsets):
+        if realtime:
+            wait = offset / speed - (time.monotonic() - started)
+            if wait > 0:
+                await asyncio.sleep(wait)
+        yield event
@@ -0,0 +1,134 @@
+"""
+Upstream conversation continuation.
+
+Each conversation (identified by a client-held `conversation_id`) keeps the id
+of the last stored Responses API response in the Django cache. On the next
+turn only the new user message is sent, with `previous_response_id` pointing
+at that response, instead of the whole history. The client still sends its
+history, and we fall back to it whenever the handle is missing, does not match
+the client's history length (another worker, edited history) or has expired
+upstream.
+
+Agent instructions are sent on every call and come first, followed by the
+history and then the new message, so the prompt prefix stays byte-identical
+between turns and provider-side prompt caching can hit on full resends too.
+"""
+import logging
+import uuid
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+import openai
+from django.conf import settings
+from django.core.cache import cache
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+_DEFAULTS = {
+    "ENABLED": False,
+    "TTL": 60 * 60,  # seconds
+}
+
+
+def continuation_config() -> Dict[str, Any]:
+    return {**_DEFAULTS, **getattr(settings, "CHAT_CONTINUATION", {})}
+
+
+def continuation_enabled() -> bool:
+    return bool(continuation_config()["ENABLED"])
+
+
+def _cache_key(conversation_id: str) -> str:
+    return f"chat:continuation:{conversation_id}"
+
+
+def is_expired_handle_error(exc: BaseException) -> bool:
+    # The API rejects unknown/expired previous_response_id with a 404 or a 400 naming the field
+    if isinstance(exc, openai.NotFoundError):
+        return True
+    return isinstance(exc, openai.BadRequestError) and "previous_response" in str(exc).lower()
+
+
+class ContinuationPlan:
+    """What to send upstream for one turn, and where to store the new handle afterwards."""
+
+    def __init__(self, conversation_id: Optional[str], previous_response_id: Optional[str], history_len: int):
+        self.conversation_id = conversation_id
+        self.previous_response_id = previous_response_id
+        self.history_len = history_len
+
+    def input_for(self, full_input: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        # Only the new user message when continuing, everything otherwise
+        return full_input[-1:] if self.previous_response_id else full_input
+
+    def expire(self) -> None:
+        logger.info("Continuation handle for conversation %s expired; resending full history", self.conversation_id)
+        metrics.incr("continuation.expired")
+        self.previous_response_id = None
+        if self.conversation_id:
+            cache.delete(_cache_key(self.conversation_id))
+
+
+def plan_turn(conversation_id: Optional[str], history_len: int) -> ContinuationPlan:
+    """`history_len` is the number of history messages the client sent with this turn."""
+    if not continuation_enabled():
+        return ContinuationPlan(None, None, history_len)
+    conversation_id = conversation_id or uuid.uuid4().hex
+    handle = cache.get(_cache_key(conversation_id))
+    if handle and handle.get("history_len") == history_len:
+        metrics.incr("continuation.hits")
+        return ContinuationPlan(conversation_id, handle["response_id"], history_len)
+    metrics.incr("continuation.misses")
+    return ContinuationPlan(conversation_id, None, history_len)
+
+
+def _ends_on_tool_output(result) -> bool:
+    # A run stopped by tool_use_behavior ends on a function call whose output was never sent
+    # upstream; continuing from that response would be rejected.
+    new_items = getattr(result, "new_items", None) or []
+    return bool(new_items) and getattr(new_items[-1], "type", None) == "tool_call_output_item"
+
+
+def save_turn(plan: ContinuationPlan, result) -> None:
+    """Record the handle for the next turn after a successful run."""
+    if not plan.conversation_id:
+        return
+    input_tokens = sum(
+        getattr(getattr(response, "usage", None), "input_tokens", 0) or 0
+        for response in getattr(result, "raw_responses", None) or []
+    )
+    metrics.observe(f"continuation.input_tokens.{'continued' if plan.previous_response_id else 'full'}", input_tokens)
+
+    response_id = getattr(result, "last_response_id", None)
+    if not response_id or _ends_on_tool_output(result):
+        cache.delete(_cache_key(plan.conversation_id))
+        return
+    # Next turn the client will have sent this turn's user message and our reply as well
+    cache.set(
+        _cache_key(plan.conversation_id),
+        {"response_id": response_id, "history_len": plan.history_len + 2},
+        timeout=continuation_config()["TTL"],
+    )
+
+
+def run_with_fallback(run: Callable[[List[Dict[str, Any]], Optional[str]], Any], plan: ContinuationPlan, full_input):
+    """Call `run(input_data, previous_response_id)`, retrying with the full input if the handle expired."""
+    try:
+        return run(plan.input_for(full_input), plan.previous_response_id)
+    except Exception as e:
+        if plan.previous_response_id and is_expired_handle_error(e):
+            plan.expire()
+            return run(full_input, None)
+        raise
+
+
+async def arun_with_fallback(run: Callable[[List[Dict[str, Any]], Optional[str]], Awaitable[Any]], plan: ContinuationPlan, full_input):
+    """Async counterpart of `run_with_fallback`."""
+    try:
+        return await run(plan.input_for(full_input), plan.previous_response_id)
+    except Exception as e:
+        if plan.previous_response_id and is_expired_handle_error(e):
+            plan.expire()
+            return await run(full_input, None)
+        raise
@@ -0,0 +1,205 @@
+"""
+Request hedging for short, latency-critical agent runs (triage, clarification).
+
+If a run has not answered within an adaptive delay (a percentile of recently
+observed latencies), a duplicate run is started and whichever finishes first
+wins; the loser is cancelled. Hedges are paid for out of a small budget that
+refills as a fraction of normal traffic, so a slow upstream cannot double our
+load.
+
+To show what hedging buys, a small random holdout of calls is never hedged;
+`hedging_summary()` compares the p99 of hedged-eligible calls with the p99 of
+that holdout.
+"""
+import asyncio
+import logging
+import random
+import threading
+import time
+from collections import deque
+from typing import Any, Dict, Optional
+
+from django.conf import settings
+from agents import Runner
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+_DEFAULTS = {
+    "ENABLED": False,
+    "AGENTS": ["triage"],
+    "PERCENTILE": 95,
+    "MIN_DELAY": 0.25,
+    "MAX_DELAY": 4.0,
+    "WARMUP_SAMPLES": 20,
+    "BUDGET_RATIO": 0.1,
+    "BUDGET_BURST": 3,
+    "HOLDOUT_RATE": 0.05,
+}
+
+
+def hedging_config() -> Dict[str, Any]:
+    return {**_DEFAULTS, **getattr(settings, "CHAT_HEDGING", {})}
+
+
+def hedging_enabled(policy_name: str) -> bool:
+    config = hedging_config()
+    return bool(config["ENABLED"]) and policy_name in config["AGENTS"]
+
+
+class HedgePolicy:
+    """Adaptive hedge delay plus a token-bucket hedge budget for one call site."""
+
+    def __init__(self, name: str, config: Dict[str, Any]):
+        self.name = name
+        self.percentile = config["PERCENTILE"]
+        self.min_delay = config["MIN_DELAY"]
+        self.max_delay = config["MAX_DELAY"]
+        self.warmup_samples = config["WARMUP_SAMPLES"]
+        self.budget_ratio = config["BUDGET_RATIO"]
+        self.budget_burst = config["BUDGET_BURST"]
+        self.holdout_rate = config["HOLDOUT_RATE"]
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=200)
+        self._tokens = float(self.budget_burst)
+
+    def delay(self) -> float:
+        with self._lock:
+            observed = list(self._latencies)
+        # Until we have a picture of the distribution, only hedge the very slow calls.
+        if len(observed) < self.warmup_samples:
+            return self.max_delay
+        return min(self.max_delay, max(self.min_delay, metrics.percentile(observed, self.percentile)))
+
+    def deposit(self) -> None:
+        with self._lock:
+            self._tokens = min(self.budget_burst, self._tokens + self.budget_ratio)
+
+    def try_acquire(self) -> bool:
+        with self._lock:
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return True
+            return False
+
+    def record(self, latency: float) -> None:
+        with self._lock:
+            self._latencies.append(latency)
+
+
+_policies: Dict[str, HedgePolicy] = {}
+_policies_lock = threading.Lock()
+
+
+def get_policy(name: str) -> HedgePolicy:
+    with _policies_lock:
+        if name not in _policies:
+            _policies[name] = HedgePolicy(name, hedging_config())
+        return _policies[name]
+
+
+async def run_hedged(starting_agent, input_data, context_obj=None, policy_name: str = "triage", previous_response_id: Optional[str] = None):
+    """
+    Same contract as `Runner.run`, but a duplicate run is fired if the first one
+    is slower than the policy's current delay and the hedge budget allows it.
+    """
+    policy = get_policy(policy_name)
+    policy.deposit()
+    prefix = f"hedge.{policy_name}"
+    metrics.incr(f"{prefix}.requests")
+
+    def _start():
+        # Each attempt gets its own copy so neither run can see the other's mutations.
+        return asyncio.ensure_future(Runner.run(
+            starting_agent=starting_agent,
+            input=list(input_data) if isinstance(input_data, list) else input_data,
+            context=context_obj,
+            previous_response_id=previous_response_id,
+        ))
+
+    started = time.monotonic()
+    primary = _start()
+
+    if random.random() < policy.holdout_rate:
+        metrics.incr(f"{prefix}.holdout")
+        try:
+            return await primary
+        finally:
+            elapsed = time.monotonic() - started
+            policy.record(elapsed)
+            metrics.observe(f"{prefix}.holdout_latency", elapsed)
+
+    delay = policy.delay()
+    try:
+        done, _ = await asyncio.wait({primary}, timeout=delay)
+    except asyncio.CancelledError:
+        # wait() leaves its tasks running; the caller (e.g. a disconnected client) is gone
+        primary.cancel()
+        raise
+
+    if done or not policy.try_acquire():
+        if not done:
+            metrics.incr(f"{prefix}.budget_exhausted")
+        try:
+            return await primary
+        finally:
+            elapsed = time.monotonic() - started
+            policy.record(elapsed)
+            metrics.observe(f"{prefix}.latency", elapsed)
+
+    logger.info("Hedging %s run after %.3fs", policy_name, delay)
+    metrics.incr(f"{prefix}.hedged")
+    hedge = _start()
+    pending = {primary, hedge}
+    winner: Optional[asyncio.Future] = None
+    try:
+        while pending and winner is None:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if not task.cancelled() and task.exception() is None:
+                    winner = task
+                    break
+    finally:
+        for task in pending:
+            task.cancel()
+
+    elapsed = time.monotonic() - started
+    metrics.observe(f"{prefix}.latency", elapsed)
+    if winner is hedge:
+        metrics.incr(f"{prefix}.hedge_wins")
+    else:
+        # Only uncensored primary latencies feed the delay estimate.
+        policy.record(elapsed)
+
+    if winner is None:
+        # Both attempts failed; surface the primary's error like an unhedged call would.
+        return primary.result()
+    return winner.result()
+
+
+def hedging_summary() -> Dict[str, Dict[str, Optional[float]]]:
+    """
+    Hedge rate and p99 of hedged vs. holdout calls for each call site seen so far.
+    The holdout figures are None until the holdout has samples.
+    """
+    summary = {}
+    with _policies_lock:
+        names = list(_policies)
+    for name in names:
+        prefix = f"hedge.{name}"
+        requests = metrics.counter(f"{prefix}.requests")
+        p99 = metrics.percentile(metrics.samples(f"{prefix}.latency"), 99)
+        holdout = metrics.samples(f"{prefix}.holdout_latency")
+        p99_unhedged = metrics.percentile(holdout, 99) if holdout else None
+        summary[name] = {
+            "requests": requests,
+            "hedge_rate": metrics.counter(f"{prefix}.hedged") / requests if requests else 0.0,
+            "hedge_wins": metrics.counter(f"{prefix}.hedge_wins"),
+            "current_delay": get_policy(name).delay(),
+            "p99": p99,
+            "holdout_samples": len(holdout),
+            "p99_unhedged": p99_unhedged,
+            "p99_improvement": p99_unhedged - p99 if p99_unhedged is not None else None,
+        }
+    return summary
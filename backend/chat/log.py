@@ -0,0 +1,104 @@
+"""
+Logging helpers for the chat hot path.
+
+- `JsonFormatter` emits one JSON object per record.
+- `QueueStreamHandler` only enqueues records on the calling thread; formatting
+  and the actual write to the stream happen on a background listener thread,
+  started lazily in each process. The queue is bounded and records are dropped
+  (and counted) instead of blocking a request when it is full.
+- `sampled_debug` logs only a fraction of DEBUG records, for code that runs per
+  stream delta.
+
+Both classes are meant to be referenced from `settings.LOGGING`.
+"""
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+from datetime import datetime, timezone
+
+from . import metrics
+
+# Attributes every LogRecord has; anything else came in through `extra=`.
+_RESERVED_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        payload = {
+            "ts": datetime.fromtimestamp(record.created, tz=timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+            "thread": record.threadName,
+        }
+        for key, value in vars(record).items():
+            if key not in _RESERVED_ATTRS and not key.startswith("_"):
+                payload[key] = value
+        if record.exc_info:
+            payload["exc_info"] = self.formatException(record.exc_info)
+        if record.stack_info:
+            payload["stack_info"] = self.formatStack(record.stack_info)
+        return json.dumps(payload, default=str)
+
+
+class QueueStreamHandler(logging.Handler):
+    """
+    Enqueues records for a `QueueListener` thread that formats and writes them.
+
+    A plain `Handler` rather than a `QueueHandler` subclass: since Python 3.12
+    `dictConfig` treats `QueueHandler` subclasses specially and expects a
+    `handlers` list. The listener starts with the first record in each process,
+    so a handler configured before a fork (gunicorn --preload) gets a live
+    listener in every worker.
+    """
+
+    def __init__(self, stream=None, maxsize: int = 10000):
+        super().__init__()
+        self.maxsize = maxsize
+        self.target = logging.StreamHandler(stream or sys.stderr)
+        self.queue = None
+        self.listener = None
+        self._pid = None
+        atexit.register(self._stop_listener)
+
+    def setFormatter(self, fmt):
+        # dictConfig sets the formatter on us; the listener thread does the formatting
+        super().setFormatter(fmt)
+        self.target.setFormatter(fmt)
+
+    def _start_listener(self) -> None:
+        self.queue = queue.Queue(maxsize=self.maxsize)
+        self.listener = logging.handlers.QueueListener(self.queue, self.target, respect_handler_level=False)
+        self.listener.start()
+        self._pid = os.getpid()
+
+    def emit(self, record: logging.LogRecord) -> None:
+        # Called with self.lock held. Records stay in-process, so they are queued unformatted;
+        # msg % args is only evaluated on the listener thread.
+        if self._pid != os.getpid():
+            self._start_listener()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            metrics.incr("logging.dropped")
+
+    def _stop_listener(self):
+        # Flushes what is still queued; safe to call more than once, and a no-op in a forked
+        # child that never logged (the parent's thread does not exist there)
+        if self.listener is not None and self._pid == os.getpid() and self.listener._thread is not None:
+            self.listener.stop()
+
+    def close(self):
+        self._stop_listener()
+        super().close()
+
+
+def sampled_debug(logger: logging.Logger, rate: float, msg: str, *args) -> None:
+    """Log `msg` at DEBUG for roughly `rate` of calls (and not at all if DEBUG is off)."""
+    if logger.isEnabledFor(logging.DEBUG) and random.random() < rate:
+        logger.debug(msg, *args, extra={"sample_rate": rate})
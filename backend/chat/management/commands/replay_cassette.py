@@ -0,0 +1,84 @@
+import asyncio
+import cProfile
+import pstats
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.cassettes import load_cassette, replay_events
+
+
+class Command(BaseCommand):
+    help = (
+        "Replay recorded agent stream cassettes through the event pipeline and SSE frame "
+        "code of MultiAgentChatStreamView and report per-token server overhead. "
+        "No OpenAI calls are made. Use --repeat to get a long-running process for py-spy."
+    )
+    # A standalone profiling tool: deployment checks (CORS origins etc.) do not apply
+    requires_system_checks = []
+
+    def add_arguments(self, parser):
+        parser.add_argument("cassettes", nargs="+", help="Cassette files (.jsonl.gz)")
+        parser.add_argument("--realtime", action="store_true", help="Keep the recorded spacing between events")
+        parser.add_argument("--speed", type=float, default=1.0, help="Speed-up factor for --realtime")
+        parser.add_argument("--repeat", type=int, default=1, help="Replay each cassette this many times")
+        parser.add_argument("--profile", metavar="FILE", help="Write cProfile stats to FILE")
+
+    def handle(self, *args, **options):
+        # views builds the OpenAI client at import; any non-empty OPENAI_API_KEY is enough for replay
+        from chat import views
+
+        agents_by_name = {
+            agent.name: agent
+            for agent in (views.triage_agent, views.issue_detector_agent, views.faq_agent, views.query_clarification_agent)
+        }
+
+        cassettes = []
+        for path in options["cassettes"]:
+            try:
+                cassette = load_cassette(path)
+            except (OSError, ValueError) as e:
+                raise CommandError(f"Could not load cassette {path}: {e}")
+            agent_name = cassette["header"].get("agent")
+            cassettes.append((path, agent_name, agents_by_name.get(agent_name), cassette["events"]))
+
+        profiler = cProfile.Profile() if options["profile"] else None
+
+        async def _replay(agent, agent_name, records):
+            frames = deltas = size = 0
+            events = replay_events(records, realtime=options["realtime"], speed=options["speed"])
+            # Same layers as a live stream; recorded tool deltas pass through the merge as run events
+            tool_deltas = asyncio.Queue() if views.uses_tool_stream(agent) else None
+            events, _ = views.event_pipeline(events, agent_name, tool_deltas)
+            async for frame in views.sse_frames(events, agent, agent_name):
+                frames += 1
+                size += len(frame)
+                if frame.startswith("data: {\"delta\""):
+                    deltas += 1
+            return frames, deltas, size
+
+        for path, agent_name, agent, records in cassettes:
+            totals = {"frames": 0, "deltas": 0, "bytes": 0}
+            wall_started, cpu_started = time.perf_counter(), time.process_time()
+            if profiler:
+                profiler.enable()
+            for _ in range(options["repeat"]):
+                frames, deltas, size = asyncio.run(_replay(agent, agent_name, records))
+                totals["frames"] += frames
+                totals["deltas"] += deltas
+                totals["bytes"] += size
+            if profiler:
+                profiler.disable()
+            wall = time.perf_counter() - wall_started
+            cpu = time.process_time() - cpu_started
+            per_delta_us = cpu / totals["deltas"] * 1e6 if totals["deltas"] else 0.0
+            self.stdout.write(
+                f"{path}: agent={agent_name!r} events={len(records) * options['repeat']} "
+                f"frames={totals['frames']} deltas={totals['deltas']} bytes={totals['bytes']} "
+                f"wall={wall:.4f}s cpu={cpu:.4f}s cpu_per_delta={per_delta_us:.1f}us"
+            )
+
+        if profiler:
+            profiler.dump_stats(options["profile"])
+            pstats.Stats(profiler, stream=self.stdout).sort_stats("cumulative").print_stats(20)
+            self.stdout.write(f"Profile written to {options['profile']}")
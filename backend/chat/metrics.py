@@ -0,0 +1,68 @@
+"""
+In-process counters and latency samples for the chat views.
+
+Everything lives in module-level state guarded by a lock, so numbers are per
+worker process. `snapshot()` is what the metrics endpoint returns.
+"""
+import threading
+from collections import defaultdict, deque
+from typing import Dict, Iterable, List
+
+# --- Storage ---
+_SAMPLE_WINDOW = 1000
+_lock = threading.Lock()
+_counters: Dict[str, float] = defaultdict(float)
+_samples: Dict[str, deque] = defaultdict(lambda: deque(maxlen=_SAMPLE_WINDOW))
+
+
+def incr(name: str, value: float = 1) -> None:
+    with _lock:
+        _counters[name] += value
+
+
+def observe(name: str, value: float) -> None:
+    """Record one sample (e.g. a latency in seconds) for `name`."""
+    with _lock:
+        _samples[name].append(value)
+
+
+def samples(name: str) -> List[float]:
+    with _lock:
+        return list(_samples.get(name, ()))
+
+
+def counter(name: str) -> float:
+    with _lock:
+        return _counters.get(name, 0)
+
+
+def percentile(values: Iterable[float], pct: float) -> float:
+    """Nearest-rank percentile; returns 0.0 for an empty series."""
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    rank = max(0, min(len(ordered) - 1, int(round(pct / 100.0 * len(ordered))) - 1))
+    return ordered[rank]
+
+
+def snapshot() -> Dict[str, Dict]:
+    with _lock:
+        counters = dict(_counters)
+        series = {name: list(values) for name, values in _samples.items()}
+    return {
+        "counters": counters,
+        "latency": {
+            name: {
+                "count": len(values),
+                "p50": percentile(values, 50),
+                "p99": percentile(values, 99),
+            }
+            for name, values in series.items()
+        },
+    }
+
+
+def reset() -> None:
+    with _lock:
+        _counters.clear()
+        _samples.clear()
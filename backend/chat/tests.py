@@ -1,3 +1,843 @@
-from django.test import TestCase
+import asyncio
+import base64
+import contextlib
+import itertools
+import io
+import json
+import logging
+import logging.config
+import os
+import tempfile
+import threading
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+from agents import RunContextWrapper
+from openai.types.responses import ResponseFunctionCallArgumentsDeltaEvent, ResponseTextDeltaEvent
+
+import httpx
+import openai
+
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from asgiref.sync import async_to_sync
+from django.test import SimpleTestCase, override_settings
+
+# views builds its OpenAI clients at import time; nothing here reaches the API
+os.environ.setdefault("OPENAI_API_KEY", "sk-test")
+
+from . import continuation, hedging, metrics, views, websocket
+from .cassettes import load_cassette, record_cassette, replay_events
+from .log import QueueStreamHandler
+from .tool_stream import ToolDeltaEvent, merge_tool_deltas
+
+
+class FakeRunner:
+    """Stands in for `agents.Runner`: attempt N sleeps delays[N] and returns "attempt-N"."""
+
+    def __init__(self, delays, errors=()):
+        self.delays = list(delays)
+        self.errors = set(errors)
+        self.started = []
+        self.cancelled = []
+
+    async def run(self, starting_agent, input, context=None, previous_response_id=None):
+        index = len(self.started)
+        self.started.append(index)
+        try:
+            await asyncio.sleep(self.delays[index])
+        except asyncio.CancelledError:
+            self.cancelled.append(index)
+            raise
+        if index in self.errors:
+            raise RuntimeError(f"attempt-{index} failed")
+        return f"attempt-{index}"
+
+
+HEDGING_TEST_SETTINGS = {
+    "ENABLED": True,
+    "AGENTS": ["triage"],
+    "MIN_DELAY": 0.02,
+    "MAX_DELAY": 0.02,
+    "WARMUP_SAMPLES": 0,
+    "BUDGET_BURST": 3,
+    "HOLDOUT_RATE": 0,
+}
+
+
+@override_settings(CHAT_HEDGING=HEDGING_TEST_SETTINGS)
+class RunHedgedTests(SimpleTestCase):
+    def setUp(self):
+        metrics.reset()
+        hedging._policies.clear()
+
+    async def _run(self, runner):
+        with mock.patch.object(hedging, "Runner", runner):
+            return await hedging.run_hedged("agent", [{"role": "user", "content": "hi"}])
+
+    async def test_fast_primary_is_not_hedged(self):
+        runner = FakeRunner([0])
+        self.assertEqual(await self._run(runner), "attempt-0")
+        self.assertEqual(runner.started, [0])
+        self.assertEqual(metrics.counter("hedge.triage.hedged"), 0)
+
+    async def test_hedge_wins_and_primary_is_cancelled(self):
+        runner = FakeRunner([1.0, 0])
+        self.assertEqual(await self._run(runner), "attempt-1")
+        await asyncio.sleep(0)
+        self.assertEqual(runner.cancelled, [0])
+        self.assertEqual(metrics.counter("hedge.triage.hedge_wins"), 1)
+
+    async def test_primary_wins_and_hedge_is_cancelled(self):
+        runner = FakeRunner([0.05, 1.0])
+        self.assertEqual(await self._run(runner), "attempt-0")
+        await asyncio.sleep(0)
+        self.assertEqual(runner.cancelled, [1])
+        self.assertEqual(metrics.counter("hedge.triage.hedge_wins"), 0)
+
+    async def test_failed_attempt_does_not_win(self):
+        runner = FakeRunner([0.05, 0.1], errors={1})
+        self.assertEqual(await self._run(runner), "attempt-0")
+
+    async def test_caller_cancellation_cancels_primary(self):
+        runner = FakeRunner([1.0])
+        task = asyncio.ensure_future(self._run(runner))
+        await asyncio.sleep(0.005)  # Inside the hedge delay
+        task.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await task
+        await asyncio.sleep(0)
+        self.assertEqual(runner.cancelled, [0])
+
+    async def test_no_hedge_without_budget(self):
+        with override_settings(CHAT_HEDGING={**HEDGING_TEST_SETTINGS, "BUDGET_BURST": 0}):
+            hedging._policies.clear()
+            runner = FakeRunner([0.05])
+            self.assertEqual(await self._run(runner), "attempt-0")
+        self.assertEqual(runner.started, [0])
+        self.assertEqual(metrics.counter("hedge.triage.budget_exhausted"), 1)
+
+
+@override_settings(CHAT_HEDGING=HEDGING_TEST_SETTINGS)
+class HedgingSummaryTests(SimpleTestCase):
+    def setUp(self):
+        metrics.reset()
+        hedging._policies.clear()
+
+    def test_no_holdout_samples_reports_none(self):
+        hedging.get_policy("triage")
+        metrics.observe("hedge.triage.latency", 0.5)
+        summary = hedging.hedging_summary()["triage"]
+        self.assertEqual(summary["holdout_samples"], 0)
+        self.assertIsNone(summary["p99_unhedged"])
+        self.assertIsNone(summary["p99_improvement"])
+
+    def test_improvement_against_holdout(self):
+        hedging.get_policy("triage")
+        metrics.observe("hedge.triage.latency", 0.5)
+        metrics.observe("hedge.triage.holdout_latency", 2.0)
+        summary = hedging.hedging_summary()["triage"]
+        self.assertEqual(summary["holdout_samples"], 1)
+        self.assertAlmostEqual(summary["p99_improvement"], 1.5)
+
+
+class QueueStreamHandlerTests(SimpleTestCase):
+    def _config(self, stream):
+        return {
+            "version": 1,
+            "disable_existing_loggers": False,
+            "formatters": {"json": {"()": "chat.log.JsonFormatter"}},
+            "handlers": {
+                "default": {"class": "chat.log.QueueStreamHandler", "formatter": "json", "stream": stream},
+            },
+            "loggers": {"chat.tests.queue": {"handlers": ["default"], "level": "INFO", "propagate": False}},
+        }
+
+    def test_dict_config_writes_json_from_listener(self):
+        stream = io.StringIO()
+        logging.config.dictConfig(self._config(stream))
+        logger = logging.getLogger("chat.tests.queue")
+        handler = logger.handlers[0]
+        self.addCleanup(handler.close)
+        self.assertIsNone(handler.listener)  # Started by the first record, not by configuration
+
+        logger.info("hello %s", "world", extra={"turn": 3})
+        handler._stop_listener()
+        record = json.loads(stream.getvalue())
+        self.assertEqual(record["msg"], "hello world")
+        self.assertEqual(record["turn"], 3)
+
+    def test_listener_restarts_in_forked_process(self):
+        stream = io.StringIO()
+        handler = QueueStreamHandler(stream=stream)
+        self.addCleanup(handler.close)
+        handler.handle(logging.LogRecord("chat", logging.INFO, "", 0, "before", (), None))
+        parent_listener = handler.listener
+        parent_listener.stop()
+        handler._pid = -1  # As seen from a child forked after the first record
+        handler.handle(logging.LogRecord("chat", logging.INFO, "", 0, "after", (), None))
+        self.assertIsNot(handler.listener, parent_listener)
+        handler._stop_listener()
+        self.assertIn("after", stream.getvalue())
+
+
+async def _events(*items, delay=0.0):
+    for item in items:
+        await asyncio.sleep(delay)
+        yield item
+
+
+class MergeToolDeltasTests(SimpleTestCase):
+    async def _collect(self, events, queue):
+        return [item async for item in merge_tool_deltas(events, queue)]
+
+    async def test_passes_run_events_through(self):
+        queue = asyncio.Queue()
+        self.assertEqual(await self._collect(_events("a", "b"), queue), ["a", "b"])
+
+    async def test_deltas_interleave_in_arrival_order(self):
+        queue = asyncio.Queue()
+
+        async def events():
+            yield "run-1"
+            queue.put_nowait(ToolDeltaEvent("x", "tool", "agent"))
+            await asyncio.sleep(0.01)
+            yield "run-2"
+
+        merged = await self._collect(events(), queue)
+        self.assertEqual([getattr(item, "delta", item) for item in merged], ["run-1", "x", "run-2"])
+
+    async def test_deltas_queued_at_the_end_are_flushed(self):
+        queue = asyncio.Queue()
+
+        async def events():
+            yield "run-1"
+            queue.put_nowait(ToolDeltaEvent("late", "tool", "agent"))
+
+        merged = await self._collect(events(), queue)
+        self.assertEqual([getattr(item, "delta", item) for item in merged], ["run-1", "late"])
+
+    async def test_closing_cancels_the_pending_read(self):
+        queue = asyncio.Queue()
+        closed = []
+
+        async def events():
+            try:
+                yield "run-1"
+                await asyncio.sleep(10)
+                yield "never"
+            except asyncio.CancelledError:
+                closed.append(True)
+                raise
+
+        merged = merge_tool_deltas(events(), queue)
+        self.assertEqual(await merged.__anext__(), "run-1")
+        reader = asyncio.ensure_future(merged.__anext__())
+        await asyncio.sleep(0.01)
+        reader.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await reader
+        await asyncio.sleep(0)
+        self.assertEqual(closed, [True])
+
+
+def _run_result(response_id="resp_1", input_tokens=100, last_item_type="message_output_item"):
+    return SimpleNamespace(
+        last_response_id=response_id,
+        raw_responses=[SimpleNamespace(usage=SimpleNamespace(input_tokens=input_tokens))],
+        new_items=[SimpleNamespace(type=last_item_type)],
+    )
+
+
+@override_settings(CHAT_CONTINUATION={"ENABLED": True, "TTL": 60})
+class ContinuationTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        metrics.reset()
+
+    def test_disabled_plans_full_resend(self):
+        with override_settings(CHAT_CONTINUATION={"ENABLED": False}):
+            plan = continuation.plan_turn("conv", 2)
+        self.assertIsNone(plan.conversation_id)
+        self.assertIsNone(plan.previous_response_id)
+
+    def test_first_turn_gets_an_id_and_full_input(self):
+        plan = continuation.plan_turn(None, 0)
+        self.assertTrue(plan.conversation_id)
+        history = [{"role": "user", "content": "hi"}]
+        self.assertEqual(plan.input_for(history), history)
+        self.assertEqual(metrics.counter("continuation.misses"), 1)
+
+    def test_saved_turn_is_continued_with_matching_history(self):
+        plan = continuation.plan_turn("conv", 0)
+        continuation.save_turn(plan, _run_result("resp_1"))
+
+        next_plan = continuation.plan_turn("conv", 2)
+        self.assertEqual(next_plan.previous_response_id, "resp_1")
+        history = [{"role": "user", "content": "a"}, {"role": "assistant", "content": "b"}, {"role": "user", "content": "c"}]
+        self.assertEqual(next_plan.input_for(history), history[-1:])
+        self.assertEqual(metrics.samples("continuation.input_tokens.full"), [100])
+
+    def test_history_length_mismatch_falls_back(self):
+        continuation.save_turn(continuation.plan_turn("conv", 0), _run_result("resp_1"))
+        self.assertIsNone(continuation.plan_turn("conv", 4).previous_response_id)
+
+    def test_run_ending_on_tool_output_clears_the_handle(self):
+        continuation.save_turn(continuation.plan_turn("conv", 0), _run_result("resp_1"))
+        plan = continuation.plan_turn("conv", 2)
+        continuation.save_turn(plan, _run_result("resp_2", last_item_type="tool_call_output_item"))
+        self.assertIsNone(continuation.plan_turn("conv", 4).previous_response_id)
+
+    def test_expired_handle_retries_with_full_input(self):
+        continuation.save_turn(continuation.plan_turn("conv", 0), _run_result("resp_1"))
+        plan = continuation.plan_turn("conv", 2)
+        calls = []
+
+        def run(input_data, previous_response_id):
+            calls.append((len(input_data), previous_response_id))
+            if previous_response_id:
+                raise openai.NotFoundError("gone", response=httpx.Response(404, request=httpx.Request("POST", "https://x")), body=None)
+            return "ok"
+
+        history = [{"role": "user", "content": "a"}, {"role": "assistant", "content": "b"}, {"role": "user", "content": "c"}]
+        self.assertEqual(continuation.run_with_fallback(run, plan, history), "ok")
+        self.assertEqual(calls, [(1, "resp_1"), (3, None)])
+        self.assertIsNone(cache.get("chat:continuation:conv"))
+
+
+class ImageToolContextTests(SimpleTestCase):
+    def test_images_are_not_logged_with_the_context(self):
+        context = views.ChatContext(user_id="42", images=[("aGVsbG8=", "image/png")])
+        self.assertNotIn("aGVsbG8=", str(context))
+        self.assertNotIn("aGVsbG8=", repr(context))
+        self.assertIn("42", str(context))
+
+    async def _invoke(self, images, description):
+        context = RunContextWrapper(views.ChatContext(images=images))
+        return await views.analyze_property_image_tool.on_invoke_tool(context, json.dumps({"user_description": description}))
+
+    async def test_concurrent_runs_see_their_own_images(self):
+        seen = {}
+
+        async def fake_completion(messages, tool_stream=None):
+            await asyncio.sleep(0.01)  # Let the other run interleave
+            urls = [part["image_url"]["url"] for part in messages[0]["content"] if part["type"] == "image_url"]
+            seen[messages[0]["content"][0]["text"].rsplit("'", 2)[-2]] = urls
+            return "ok"
+
+        image_a = (base64.b64encode(b"a").decode(), "image/png")
+        image_b = (base64.b64encode(b"b").decode(), "image/jpeg")
+        with mock.patch.object(views, "_vision_completion", fake_completion):
+            results = await asyncio.gather(
+                self._invoke([image_a], "run-a"),
+                self._invoke([], "run-b"),
+                self._invoke([image_b], "run-c"),
+            )
+        self.assertEqual(results[1], "Error: No image data provided.")
+        self.assertEqual(seen["run-a"], [f"data:image/png;base64,{image_a[0]}"])
+        self.assertEqual(seen["run-c"], [f"data:image/jpeg;base64,{image_b[0]}"])
+
+
+def _upload(name, size, content_type="image/jpeg"):
+    return SimpleUploadedFile(name, b"x" * size, content_type=content_type)
+
+
+@mock.patch.multiple(views, MAX_IMAGES_PER_TURN=3, MAX_IMAGE_BYTES=100, MAX_TOTAL_IMAGE_BYTES=250)
+class ReadUploadedImagesTests(SimpleTestCase):
+    def assertRejected(self, files, status_code):
+        with self.assertRaises(views.ImageUploadError) as raised:
+            views.read_uploaded_images(files)
+        self.assertEqual(raised.exception.status_code, status_code)
+
+    def test_images_within_limits_are_encoded(self):
+        images = views.read_uploaded_images([_upload("a.jpg", 100), _upload("b.png", 50, "image/png")])
+        self.assertEqual(images, [
+            (base64.b64encode(b"x" * 100).decode(), "image/jpeg"),
+            (base64.b64encode(b"x" * 50).decode(), "image/png"),
+        ])
+
+    def test_too_many_images(self):
+        self.assertRejected([_upload(f"{n}.jpg", 10) for n in range(4)], 400)
+
+    def test_non_image_content_type(self):
+        self.assertRejected([_upload("a.jpg", 10), _upload("notes.pdf", 10, "application/pdf")], 400)
+
+    def test_oversized_image(self):
+        self.assertRejected([_upload("a.jpg", 101)], 413)
+
+    def test_total_size_over_limit(self):
+        self.assertRejected([_upload(f"{n}.jpg", 90) for n in range(3)], 413)
+
+
+class ImageAnalysisStrategyTests(SimpleTestCase):
+    """Batch vs per-photo requests; the fake completion records each request it gets."""
+
+    def setUp(self):
+        self.requests = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.failing_photos = set()
+
+    async def fake_completion(self, messages, tool_stream=None):
+        content = messages[0]["content"]
+        photos = [part for part in content if part["type"] == "image_url"]
+        self.requests.append((content[0]["text"], len(photos)))
+        if not photos:
+            return "**Property Issue Detector:** Combined assessment."
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(0.01)
+        finally:
+            self.in_flight -= 1
+        photo = base64.b64decode(photos[0]["image_url"]["url"].split(",", 1)[1]).decode()
+        if photo in self.failing_photos:
+            raise _api_error()
+        return f"Finding for {photo}."
+
+    async def _invoke(self, photos):
+        images = [(base64.b64encode(photo.encode()).decode(), "image/jpeg") for photo in photos]
+        context = RunContextWrapper(views.ChatContext(images=images))
+        with mock.patch.object(views, "_vision_completion", self.fake_completion):
+            return await views.analyze_property_image_tool.on_invoke_tool(context, json.dumps({"user_description": "damp wall"}))
+
+    @mock.patch.object(views, "IMAGE_BATCH_MAX_BYTES", 1000)
+    async def test_photos_that_fit_are_batched(self):
+        output = await self._invoke(["one", "two", "three"])
+        self.assertEqual([photos for _, photos in self.requests], [3])
+        self.assertIn("3 photos of the same problem", self.requests[0][0])
+        self.assertEqual(output, "Finding for one.")
+
+    @mock.patch.object(views, "IMAGE_BATCH_MAX_BYTES", 8)
+    async def test_photos_over_the_batch_size_are_analyzed_one_by_one(self):
+        output = await self._invoke(["one", "two", "three"])
+        self.assertEqual(sorted(photos for _, photos in self.requests), [0, 1, 1, 1])
+        synthesis_prompt = self.requests[-1][0]
+        self.assertIn("Combine them into one brief assessment", synthesis_prompt)
+        self.assertIn("**Photo 2:** Finding for two.", synthesis_prompt)
+        self.assertEqual(output, "**Property Issue Detector:** Combined assessment.")
+
+    @mock.patch.multiple(views, IMAGE_BATCH_MAX_BYTES=8, IMAGE_ANALYSIS_CONCURRENCY=2)
+    async def test_parallel_requests_respect_the_concurrency_bound(self):
+        await self._invoke(["one", "two", "three", "four"])
+        self.assertEqual(len(self.requests), 5)
+        self.assertEqual(self.max_in_flight, 2)
+
+    @mock.patch.object(views, "IMAGE_BATCH_MAX_BYTES", 8)
+    async def test_failed_photo_is_reported_to_the_synthesis(self):
+        self.failing_photos = {"two"}
+        output = await self._invoke(["one", "two", "three"])
+        synthesis_prompt = self.requests[-1][0]
+        self.assertIn("**Photo 1:** Finding for one.", synthesis_prompt)
+        self.assertIn("**Photo 2:** This photo could not be analyzed.", synthesis_prompt)
+        self.assertTrue(views.is_final_image_output(output))
+
+    @mock.patch.object(views, "IMAGE_BATCH_MAX_BYTES", 8)
+    async def test_all_photos_failing_is_an_error(self):
+        self.failing_photos = {"one", "two"}
+        output = await self._invoke(["one", "two"])
+        self.assertEqual(output, "Error: AI service failed (APIConnectionError).")
+        self.assertFalse(views.is_final_image_output(output))
+
+
+class FakeCompletionStream:
+    """An `AsyncStream` of chat completion chunks that raises `error` after `texts`."""
+
+    def __init__(self, texts, error=None):
+        self.texts = texts
+        self.error = error
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    async def __aiter__(self):
+        for text in self.texts:
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=text))])
+        if self.error is not None:
+            raise self.error
+
+
+def _api_error():
+    return openai.APIConnectionError(request=httpx.Request("POST", "https://api.openai.com/v1/chat/completions"))
+
+
+class VisionStreamTests(SimpleTestCase):
+    def setUp(self):
+        metrics.reset()
+
+    async def _complete(self, stream):
+        queue = asyncio.Queue()
+        create = mock.AsyncMock(return_value=stream)
+        with mock.patch.object(views.async_client.chat.completions, "create", create):
+            output = await views._vision_completion(views._vision_messages("prompt", []), queue)
+        deltas = []
+        while not queue.empty():
+            deltas.append(queue.get_nowait().delta)
+        return output, deltas
+
+    async def test_failure_after_deltas_closes_off_the_streamed_answer(self):
+        output, deltas = await self._complete(FakeCompletionStream(["**Property Issue Detector:** ", "A leak"], _api_error()))
+        self.assertEqual(deltas, ["**Property Issue Detector:** ", "A leak", views._VISION_INTERRUPTED_NOTE])
+        self.assertEqual(output, "".join(deltas))
+        # Final, so the detector does not answer again below the partial analysis
+        self.assertTrue(views.is_final_image_output(output))
+        self.assertEqual(metrics.counter("tool.analyze_property_image.interrupted"), 1)
+
+    async def test_failure_before_any_delta_is_raised(self):
+        with self.assertRaises(openai.APIConnectionError):
+            await self._complete(FakeCompletionStream([], _api_error()))
+
+
+class FakeSocket:
+    """An ASGI websocket peer: feed it client messages, read back what the server sent."""
+
+    def __init__(self):
+        self.incoming = asyncio.Queue()
+        self.sent = []
+
+    async def receive(self):
+        return await self.incoming.get()
+
+    async def send(self, message):
+        self.sent.append(message)
+
+    def client_sends(self, text=None, data=None):
+        if text is not None:
+            self.incoming.put_nowait({"type": "websocket.receive", "text": text})
+        else:
+            self.incoming.put_nowait({"type": "websocket.receive", "bytes": data})
+
+    def texts(self):
+        return [json.loads(message["text"]) for message in self.sent if message["type"] == "websocket.send"]
+
+
+def _fake_turn(frames, delay=0.0, cancelled=None):
+    """Patches for route_turn / stream_turn_frames that stream `frames` without running agents."""
+    async def route_turn(*args, **kwargs):
+        return "agent"
+
+    async def stream_turn_frames(*args, **kwargs):
+        try:
+            for frame in frames:
+                await asyncio.sleep(delay)
+                yield frame
+        except (asyncio.CancelledError, GeneratorExit):
+            if cancelled is not None:
+                cancelled.append(True)
+            raise
+
+    return mock.patch.multiple(websocket, route_turn=route_turn, stream_turn_frames=stream_turn_frames)
+
+
+class WebSocketTests(SimpleTestCase):
+    def setUp(self):
+        metrics.reset()
+
+    @contextlib.asynccontextmanager
+    async def _connected(self):
+        peer = FakeSocket()
+        peer.incoming.put_nowait({"type": "websocket.connect"})
+        connection = asyncio.ensure_future(websocket.websocket_application({"path": "/multiagent/ws/"}, peer.receive, peer.send))
+        await asyncio.sleep(0)
+        try:
+            yield peer
+        finally:
+            peer.incoming.put_nowait({"type": "websocket.disconnect"})
+            await asyncio.wait_for(connection, 1)
+
+    async def _settle(self):
+        for _ in range(5):
+            await asyncio.sleep(0.01)
+
+    def test_ws_payload(self):
+        self.assertEqual(websocket.ws_payload('data: {"delta": "hi"}\n\n'), '{"delta": "hi"}')
+        self.assertEqual(json.loads(websocket.ws_payload("event: end\ndata: {}\n\n")), {"event": "end"})
+
+    async def test_unknown_path_is_closed(self):
+        peer = FakeSocket()
+        peer.incoming.put_nowait({"type": "websocket.connect"})
+        await websocket.websocket_application({"path": "/other/"}, peer.receive, peer.send)
+        self.assertEqual(peer.sent, [{"type": "websocket.close", "code": 4404}])
+
+    async def test_too_many_announced_images_are_rejected_up_front(self):
+        async with self._connected() as peer:
+            images = [{"content_type": "image/png"}] * (websocket.MAX_IMAGES_PER_TURN + 1)
+            peer.client_sends(json.dumps({"type": "turn", "text": "", "images": images}))
+            await self._settle()
+        self.assertIn("Too many images", peer.texts()[0]["error"])
+        self.assertEqual(peer.texts()[1], {"event": "end"})
+
+    async def test_total_image_bytes_are_capped_while_buffering(self):
+        with mock.patch.object(websocket, "MAX_TOTAL_IMAGE_BYTES", 10):
+            async with self._connected() as peer:
+                peer.client_sends(json.dumps({"type": "turn", "text": "", "images": [{"content_type": "image/png"}] * 3}))
+                peer.client_sends(data=b"x" * 6)
+                peer.client_sends(data=b"x" * 6)
+                await self._settle()
+        self.assertIn("oversized", peer.texts()[0]["error"])
+
+    async def test_turn_frames_are_forwarded_as_json(self):
+        frames = ['data: {"delta": "Hel", "agent": "A"}\n\n', 'data: {"delta": "lo", "agent": "A"}\n\n', "event: end\ndata: {}\n\n"]
+        with _fake_turn(frames):
+            async with self._connected() as peer:
+                peer.client_sends(json.dumps({"type": "turn", "text": "hi"}))
+                await self._settle()
+        self.assertEqual(peer.texts(), [{"delta": "Hel", "agent": "A"}, {"delta": "lo", "agent": "A"}, {"event": "end"}])
+
+    async def test_disconnect_is_seen_while_the_outbox_is_full(self):
+        cancelled = []
+        peer = FakeSocket()
+
+        async def stalled_send(message):
+            if message["type"] == "websocket.send":
+                await asyncio.sleep(10)  # A client that stopped reading
+
+        peer.send = stalled_send
+        peer.incoming.put_nowait({"type": "websocket.connect"})
+        with _fake_turn(itertools.repeat('data: {"delta": "x"}\n\n'), cancelled=cancelled), \
+                mock.patch.object(websocket, "OUTBOX_SIZE", 2):
+            connection = asyncio.ensure_future(websocket.websocket_application({"path": "/multiagent/ws/"}, peer.receive, peer.send))
+            peer.client_sends(json.dumps({"type": "turn", "text": "hi"}))
+            await self._settle()
+            peer.client_sends(json.dumps({"type": "turn", "text": "again"}))  # Rejected without blocking
+            peer.incoming.put_nowait({"type": "websocket.disconnect"})
+            await asyncio.wait_for(connection, 1)
+        await asyncio.sleep(0)
+        self.assertEqual(cancelled, [True])
+        self.assertEqual(metrics.counter("websocket.errors_dropped"), 1)
+
+    async def test_failed_send_cancels_the_turn(self):
+        cancelled = []
+        peer = FakeSocket()
+
+        async def broken_send(message):
+            if message["type"] == "websocket.send":
+                raise OSError("connection reset")
+
+        peer.send = broken_send
+        peer.incoming.put_nowait({"type": "websocket.connect"})
+        with _fake_turn(itertools.repeat('data: {"delta": "x"}\n\n'), delay=0.001, cancelled=cancelled):
+            connection = asyncio.ensure_future(websocket.websocket_application({"path": "/multiagent/ws/"}, peer.receive, peer.send))
+            peer.client_sends(json.dumps({"type": "turn", "text": "hi"}))
+            await asyncio.wait_for(connection, 1)  # Ends without a websocket.disconnect
+        await asyncio.sleep(0)
+        self.assertEqual(cancelled, [True])
+
+
+class FakeStreamedRun:
+    """A `Runner.run_streamed` result whose run task emits `count` text deltas."""
+
+    _DONE = object()
+
+    def __init__(self, count, delay=0.005):
+        self.is_complete = False
+        self.final_output = None
+        self.raw_responses = []
+        self.new_items = []
+        self.last_response_id = None
+        self.cancelled = False
+        self._queue = asyncio.Queue()
+        self._run_impl_task = asyncio.ensure_future(self._run(count, delay))
+
+    async def _run(self, count, delay):
+        try:
+            for index in range(count):
+                await asyncio.sleep(delay)
+                data = SimpleNamespace(type="response.output_text.delta", delta=f"t{index} ")
+                self._queue.put_nowait(SimpleNamespace(type="raw_response_event", data=data))
+            self.final_output = "done"
+            self.raw_responses = [SimpleNamespace(usage=SimpleNamespace(input_tokens=1, output_tokens=count))]
+            self.is_complete = True
+        except asyncio.CancelledError:
+            self.cancelled = True
+            raise
+        finally:
+            self._queue.put_nowait(self._DONE)
+
+    def _cleanup_tasks(self):
+        if not self._run_impl_task.done():
+            self._run_impl_task.cancel()
+
+    async def stream_events(self):
+        # Like the SDK: a cancellation landing here just ends the stream
+        while True:
+            try:
+                item = await self._queue.get()
+            except asyncio.CancelledError:
+                break
+            if item is self._DONE:
+                break
+            yield item
+        self._cleanup_tasks()
+
+
+class StreamCancellationTests(SimpleTestCase):
+    def setUp(self):
+        metrics.reset()
+        self.runs = []
+        self.completed = []
+
+    def _runner(self, count, delay=0.005):
+        def run_streamed(agent, input, context=None, previous_response_id=None):
+            run = FakeStreamedRun(count, delay)
+            self.runs.append(run)
+            return run
+        return mock.patch.object(views, "Runner", SimpleNamespace(run_streamed=run_streamed))
+
+    def _frames(self):
+        plan = continuation.ContinuationPlan(None, None, 0)
+        return views.stream_turn_frames(views.faq_agent, [{"role": "user", "content": "hi"}], views.ChatContext(), plan, "test", self.completed.append)
+
+    async def _read_then_cancel(self, frames_before_cancel):
+        received = []
+
+        async def read():
+            async for frame in self._frames():
+                received.append(frame)
+
+        reader = asyncio.ensure_future(read())
+        while len(received) < frames_before_cancel:
+            await asyncio.sleep(0.001)
+        reader.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await reader
+        return received
+
+    async def test_completed_run_is_persisted(self):
+        with self._runner(3):
+            frames = [frame async for frame in self._frames()]
+        self.assertEqual(len(frames), 3)
+        self.assertEqual(self.completed, ["done"])
+        self.assertEqual(metrics.samples("run.output_tokens.Tenancy Agreement Expert"), [3])
+
+    async def test_cancelled_reader_cancels_the_run(self):
+        metrics.observe("run.output_tokens.Tenancy Agreement Expert", 50)
+        with self._runner(100):
+            received = await self._read_then_cancel(2)
+        await asyncio.sleep(0.01)
+        self.assertTrue(self.runs[0].cancelled)
+        self.assertEqual(metrics.counter("stream.aborted"), 1)
+        # Each delta is "tN " (3 characters), at 4 characters per token
+        self.assertEqual(metrics.counter("stream.tokens_saved"), 50 - -(-3 * len(received) // 4))
+        self.assertEqual(self.completed, [])
+
+    async def test_closed_stream_cancels_the_run(self):
+        with self._runner(100):
+            frames = self._frames()
+            await frames.__anext__()
+            await frames.aclose()
+        await asyncio.sleep(0.01)
+        self.assertTrue(self.runs[0].cancelled)
+        self.assertEqual(metrics.counter("stream.aborted"), 1)
+
+    @override_settings(CHAT_DISCONNECT_GRACE_SECONDS=1)
+    async def test_run_completing_within_grace_is_persisted(self):
+        with self._runner(10):
+            await self._read_then_cancel(2)
+            await asyncio.sleep(0.2)
+        self.assertFalse(self.runs[0].cancelled)
+        self.assertEqual(self.completed, ["done"])
+        self.assertEqual(metrics.counter("stream.completed_in_grace"), 1)
+        self.assertEqual(metrics.counter("stream.aborted"), 0)
+
+    @override_settings(CHAT_DISCONNECT_GRACE_SECONDS=0.05)
+    async def test_run_outliving_grace_is_cancelled(self):
+        with self._runner(100, delay=0.01):
+            await self._read_then_cancel(2)
+            await asyncio.sleep(0.15)
+        self.assertTrue(self.runs[0].cancelled)
+        self.assertEqual(metrics.counter("stream.aborted"), 1)
+        self.assertEqual(self.completed, [])
+
+
+def _synthetic_detector_stream():
+    """One of each event kind the SSE code handles, as the SDK would emit them."""
+    detector = SimpleNamespace(name="Property Issue Detector")
+
+    def text(delta):
+        data = ResponseTextDeltaEvent(content_index=0, delta=delta, item_id="msg_1", output_index=0, type="response.output_text.delta")
+        return SimpleNamespace(type="raw_response_event", data=data)
+
+    arguments = ResponseFunctionCallArgumentsDeltaEvent(
+        delta='{"user_description": "stain on ceiling"}', item_id="fc_1", output_index=0,
+        type="response.function_call_arguments.delta",
+    )
+    return [
+        text("Let me look. "),
+        SimpleNamespace(type="raw_response_event", data=arguments),
+        ToolDeltaEvent("Water stain near the vent.", "analyze_property_image_tool", "Property Issue Detector"),
+        SimpleNamespace(type="run_item_stream_event", name="tool_output", item=SimpleNamespace(
+            type="tool_call_output_item", agent=detector,
+            raw_item={"type": "function_call_output", "call_id": "call_1", "output": "Water stain near the vent."},
+            output="Water stain near the vent.",
+        )),
+        SimpleNamespace(type="agent_updated_stream_event", new_agent=detector),
+        text("Report it to your landlord."),
+        SimpleNamespace(type="error_event", data={"error": "upstream reset"}),
+    ]
+
+
+class CassetteReplayTests(SimpleTestCase):
+    EXPECTED_FRAMES = [
+        'data: {"delta": "Let me look. ", "agent": "Property Issue Detector"}\n\n',
+        'data: {"delta": "Water stain near the vent.", "agent": "Property Issue Detector", "source": "analyze_property_image_tool"}\n\n',
+        'data: {"delta": "Report it to your landlord.", "agent": "Property Issue Detector"}\n\n',
+        'data: {"error": "upstream reset", "agent": "Property Issue Detector"}\n\n',
+        "event: end\ndata: {}\n\n",
+    ]
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "detector.jsonl.gz")
+
+    async def _record(self):
+        async def live():
+            for event in _synthetic_detector_stream():
+                yield event
+
+        passed = [event async for event in record_cassette(live(), "Property Issue Detector", self.path)]
+        self.assertEqual(len(passed), 7)
+
+    async def _frames(self, events):
+        agent = views.issue_detector_agent
+        return [frame async for frame in views.sse_frames(events, agent, agent.name)]
+
+    @mock.patch.object(views, "IMAGE_TOOL_OUTPUT_FINAL", False)
+    async def test_replay_matches_live_frames(self):
+        live_frames = await self._frames(_events(*_synthetic_detector_stream()))
+        self.assertEqual(live_frames, self.EXPECTED_FRAMES)
+
+        await self._record()
+        cassette = load_cassette(self.path)
+        self.assertEqual(cassette["header"]["agent"], "Property Issue Detector")
+        self.assertEqual(
+            [record["type"] for record in cassette["events"]],
+            ["raw_response_event", "raw_response_event", "tool_delta_event", "run_item_stream_event",
+             "agent_updated_stream_event", "raw_response_event", "error_event"],
+        )
+        self.assertEqual(await self._frames(replay_events(cassette["events"])), self.EXPECTED_FRAMES)
+
+    async def test_cancelled_recording_still_writes_the_cassette(self):
+        async def live():
+            yield _synthetic_detector_stream()[0]
+            await asyncio.sleep(10)
+
+        recorder = record_cassette(live(), "Property Issue Detector", self.path)
+        await recorder.__anext__()
+        await recorder.aclose()
+        # Written by a thread of its own, since the loop may be going away
+        for thread in threading.enumerate():
+            if thread.name == "cassette-writer":
+                thread.join(5)
+        self.assertEqual(len(load_cassette(self.path)["events"]), 1)
+
+    def test_replay_command_reports_deltas(self):
+        async_to_sync(self._record)()
+        out = io.StringIO()
+        call_command("replay_cassette", self.path, stdout=out)
+        self.assertIn("deltas=3", out.getvalue())
@@ -0,0 +1,62 @@
+"""
+Forwarding of a tool's own model output to the SSE stream of the current request.
+
+The streaming view opens a per-request queue before starting the run; the
+SDK copies the current context into the run task, so a tool can find the queue
+through a context variable and push its completion deltas while it is still
+executing. `merge_tool_deltas` interleaves those deltas with the run's
+`stream_events()` so the SSE loop sees a single event sequence.
+"""
+import asyncio
+from contextvars import ContextVar
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Optional
+
+_tool_deltas: ContextVar[Optional[asyncio.Queue]] = ContextVar("chat_tool_deltas", default=None)
+
+
+@dataclass
+class ToolDeltaEvent:
+    delta: str
+    tool_name: str
+    agent_name: str
+    type: str = "tool_delta_event"
+
+
+def open_tool_stream() -> asyncio.Queue:
+    """Create the queue for this request; call before `Runner.run_streamed`."""
+    queue: asyncio.Queue = asyncio.Queue()
+    _tool_deltas.set(queue)
+    return queue
+
+
+def current_tool_stream() -> Optional[asyncio.Queue]:
+    return _tool_deltas.get()
+
+
+async def merge_tool_deltas(events: AsyncIterator[Any], queue: asyncio.Queue) -> AsyncIterator[Any]:
+    """Yield run events and tool deltas in arrival order until the run's events end."""
+    event_iter = events.__aiter__()
+    next_event = asyncio.ensure_future(event_iter.__anext__())
+    next_delta = asyncio.ensure_future(queue.get())
+    try:
+        while True:
+            done, _ = await asyncio.wait({next_event, next_delta}, return_when=asyncio.FIRST_COMPLETED)
+            # A tool finishes (and its deltas are queued) before the run emits its output,
+            # so deltas go first when both are ready.
+            if next_delta in done:
+                yield next_delta.result()
+                next_delta = asyncio.ensure_future(queue.get())
+            if next_event in done:
+                try:
+                    event = next_event.result()
+                except StopAsyncIteration:
+                    break
+                yield event
+                next_event = asyncio.ensure_future(event_iter.__anext__())
+        while not queue.empty():
+            yield queue.get_nowait()
+    finally:
+        next_delta.cancel()
+        if not next_event.done():
+            next_event.cancel()
@@ -1,8 +1,9 @@
 from django.urls import path
 from . import views
-from .views import MultiAgentChatStreamView
+from .views import MultiAgentChatStreamView, ChatMetricsView
 
 urlpatterns = [
     path('multiagent/stream/', MultiAgentChatStreamView.as_view()),
+    path('multiagent/metrics/', ChatMetricsView.as_view()),
 
 ]
\ No newline at end of file
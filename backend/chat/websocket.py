@@ -0,0 +1,222 @@
+"""
+WebSocket transport for multi-turn chat, served next to the SSE view.
+
+One connection holds one conversation: the history stays on the server, so a
+turn is just a small JSON text frame
+
+    {"type": "turn", "text": "...", "images": [{"content_type": "image/png"}, ...]}
+
+followed by one binary frame per announced image. The first turn may also
+carry a "history" list to pick up a conversation started over SSE.
+
+Routing and streaming go through the same `route_turn` / `stream_turn_frames`
+code as `MultiAgentChatStreamView`, and each SSE frame is forwarded as one text
+frame with the same JSON payload (`{"delta", "agent"}`, `{"error", "agent"}`,
+`{"conversation_id"}`); the SSE end event becomes `{"event": "end"}`.
+
+Outgoing frames pass through a bounded per-connection queue drained by a
+single sender task, so a slow client pauses its own agent stream instead of
+buffering without limit. Errors about incoming frames never wait on that
+queue, and a failed send is handled like a disconnect.
+"""
+import asyncio
+import contextlib
+import json
+import logging
+from typing import Any, Dict, List, Optional
+
+from django.conf import settings
+from django.core.files.uploadedfile import SimpleUploadedFile
+
+from . import metrics
+from .continuation import plan_turn
+from .views import (
+    MAX_IMAGE_BYTES,
+    MAX_IMAGES_PER_TURN,
+    MAX_TOTAL_IMAGE_BYTES,
+    ChatContext,
+    ImageUploadError,
+    TurnError,
+    read_uploaded_images,
+    route_turn,
+    stream_turn_frames,
+)
+
+logger = logging.getLogger(__name__)
+
+WEBSOCKET_PATHS = {"/multiagent/ws/", "/api/multiagent/ws/"}
+OUTBOX_SIZE = getattr(settings, "CHAT_WEBSOCKET_OUTBOX_SIZE", 64)
+END_FRAME = json.dumps({"event": "end"})
+
+
+def ws_payload(frame: str) -> str:
+    """Turn one SSE frame into the JSON text sent over the socket."""
+    if frame.startswith("event: end"):
+        return END_FRAME
+    # "data: {...}\n\n" -> "{...}"
+    return frame[6:].rstrip("\n")
+
+
+class ChatWebSocket:
+    """Handles one ASGI websocket connection."""
+
+    def __init__(self, scope, receive, send):
+        self.scope = scope
+        self.receive = receive
+        self.send = send
+        self.history: List[Dict[str, Any]] = []
+        self.conversation_id: Optional[str] = None
+        self.outbox: asyncio.Queue = asyncio.Queue(maxsize=OUTBOX_SIZE)
+        self.pending_turn: Optional[Dict[str, Any]] = None
+        self.pending_images: List[SimpleUploadedFile] = []
+        self.pending_bytes = 0
+        self.turn_task: Optional[asyncio.Task] = None
+
+    async def __call__(self):
+        message = await self.receive()
+        if message["type"] != "websocket.connect":
+            return
+        await self.send({"type": "websocket.accept"})
+        metrics.incr("websocket.connections")
+        sender = asyncio.ensure_future(self._drain_outbox())
+        receiver = asyncio.ensure_future(self._receive_frames())
+        try:
+            done, _ = await asyncio.wait({sender, receiver}, return_when=asyncio.FIRST_COMPLETED)
+            if sender in done:
+                # send() only fails once the client is gone: same as a disconnect
+                logger.info("WebSocket send failed, closing connection: %r", sender.exception())
+            if receiver in done:
+                receiver.result()  # Re-raises anything the frame handlers let through
+        finally:
+            for task in (self.turn_task, receiver, sender):
+                if task is not None and not task.done():
+                    task.cancel()
+            metrics.incr("websocket.disconnects")
+
+    async def _receive_frames(self):
+        while True:
+            message = await self.receive()
+            if message["type"] == "websocket.disconnect":
+                return
+            if message.get("text") is not None:
+                await self._on_text(message["text"])
+            elif message.get("bytes") is not None:
+                await self._on_bytes(message["bytes"])
+
+    # --- Outgoing ---
+    async def _drain_outbox(self):
+        while True:
+            text = await self.outbox.get()
+            await self.send({"type": "websocket.send", "text": text})
+
+    async def _emit(self, payload: Dict[str, Any]):
+        await self.outbox.put(json.dumps(payload))
+
+    async def _emit_error(self, message: str, agent=None):
+        await self._emit({"error": message, "agent": agent})
+        await self.outbox.put(END_FRAME)
+
+    def _reject(self, message: str):
+        # For errors raised while reading frames: the receive loop must not wait on a
+        # full outbox, or it would stop noticing the client's disconnect
+        if self.outbox.maxsize and self.outbox.qsize() > self.outbox.maxsize - 2:
+            metrics.incr("websocket.errors_dropped")
+            logger.warning("WebSocket outbox full, dropping error: %s", message)
+            return
+        self.outbox.put_nowait(json.dumps({"error": message, "agent": None}))
+        self.outbox.put_nowait(END_FRAME)
+
+    # --- Incoming ---
+    async def _on_text(self, text: str):
+        try:
+            frame = json.loads(text)
+        except json.JSONDecodeError:
+            self._reject("Invalid frame: expected JSON.")
+            return
+        if not isinstance(frame, dict) or frame.get("type") != "turn":
+            self._reject("Unsupported frame type.")
+            return
+        if self.turn_task and not self.turn_task.done():
+            self._reject("A turn is already in progress.")
+            return
+        announced = frame.get("images") or []
+        if not isinstance(announced, list):
+            self._reject("'images' must be a list.")
+            return
+        # Checked before any image bytes are accepted, so a turn cannot buffer more than the limits
+        if len(announced) > MAX_IMAGES_PER_TURN:
+            self._reject(f"Too many images: at most {MAX_IMAGES_PER_TURN} per message.")
+            return
+        self.pending_turn = frame
+        self.pending_images = []
+        self.pending_bytes = 0
+        await self._maybe_start_turn()
+
+    async def _on_bytes(self, data: bytes):
+        if self.pending_turn is None:
+            self._reject("Unexpected binary frame: announce images in a turn frame first.")
+            return
+        announced = self.pending_turn.get("images") or []
+        index = len(self.pending_images)
+        if (index >= len(announced) or len(data) > MAX_IMAGE_BYTES
+                or self.pending_bytes + len(data) > MAX_TOTAL_IMAGE_BYTES):
+            # Drop the whole turn rather than hold on to bytes we will reject anyway
+            self.pending_turn, self.pending_images, self.pending_bytes = None, [], 0
+            self._reject("Unexpected or oversized image frame.")
+            return
+        self.pending_bytes += len(data)
+        content_type = announced[index].get("content_type", "") if isinstance(announced[index], dict) else ""
+        self.pending_images.append(SimpleUploadedFile(f"image-{index + 1}", data, content_type=content_type))
+        await self._maybe_start_turn()
+
+    async def _maybe_start_turn(self):
+        announced = self.pending_turn.get("images") or []
+        if len(self.pending_images) < len(announced):
+            return  # Waiting for the remaining binary frames
+        frame, image_files = self.pending_turn, self.pending_images
+        self.pending_turn, self.pending_images, self.pending_bytes = None, [], 0
+        self.turn_task = asyncio.ensure_future(self._run_turn(frame, image_files))
+
+    async def _run_turn(self, frame: Dict[str, Any], image_files: List[SimpleUploadedFile]):
+        user_text = str(frame.get("text") or "").strip()
+        if not self.history and isinstance(frame.get("history"), list):
+            self.history = [
+                item for item in frame["history"]
+                if isinstance(item, dict) and "role" in item and "content" in item
+            ]
+        metrics.incr("websocket.turns")
+
+        context_obj = ChatContext(user_id="Anonymous")
+        input_list_for_agent = list(self.history)
+        continuation = plan_turn(self.conversation_id, len(self.history))
+        self.conversation_id = continuation.conversation_id
+        try:
+            images = read_uploaded_images(image_files) if image_files else []
+            agent = await route_turn(user_text, images, input_list_for_agent, context_obj, continuation, bool(self.history))
+        except (ImageUploadError, TurnError) as e:
+            await self._emit_error(str(e), getattr(e, "agent", None))
+            return
+        except Exception as e:
+            logger.exception("WebSocket turn routing failed: %s", e)
+            await self._emit_error(f"An internal server error occurred: {str(e)}")
+            return
+
+        def remember(final_output):
+            # Also called when the run completes within the grace period after a disconnect
+            if final_output:
+                self.history = input_list_for_agent + [{"role": "assistant", "content": str(final_output)}]
+
+        # aclosing: a cancelled turn closes the stream (and its agent run) right away
+        frames = stream_turn_frames(agent, input_list_for_agent, context_obj, continuation, "Anonymous", remember)
+        async with contextlib.aclosing(frames):
+            async for sse_frame in frames:
+                # Blocks while the client is behind by OUTBOX_SIZE frames
+                await self.outbox.put(ws_payload(sse_frame))
+
+
+async def websocket_application(scope, receive, send):
+    if scope["path"] not in WEBSOCKET_PATHS:
+        await receive()  # websocket.connect
+        await send({"type": "websocket.close", "code": 4404})
+        return
+    await ChatWebSocket(scope, receive, send)()
@@ -2,6 +2,8 @@
 ASGI config for realestateassistant project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
+HTTP goes to Django; websocket connections go to the chat WebSocket endpoint
+(see chat/websocket.py).
 
 For more information on this file, see
 https://docs.djangoproject.com/en/5.1/howto/deployment/asgi/
@@ -13,4 +15,13 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'realestateassistant.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# Imported after Django is set up, since it loads the chat views
+from chat.websocket import websocket_application  # noqa: E402
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'websocket':
+        return await websocket_application(scope, receive, send)
+    return await django_application(scope, receive, send)
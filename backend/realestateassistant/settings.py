@@ -133,16 +133,91 @@ REST_FRAMEWORK = {
         'rest_framework.filters.OrderingFilter',
     ]
 }
+# Request hedging for short agent runs (see chat/hedging.py).
+# CHAT_HEDGING_AGENTS is a comma-separated list of call sites: "triage", "clarification".
+CHAT_HEDGING = {
+    'ENABLED': os.environ.get('CHAT_HEDGING', 'False').lower() == 'true',
+    'AGENTS': [name.strip() for name in os.environ.get('CHAT_HEDGING_AGENTS', 'triage').split(',') if name.strip()],
+    'PERCENTILE': float(os.environ.get('CHAT_HEDGING_PERCENTILE', '95')),
+    'MIN_DELAY': 0.25,  # seconds
+    'MAX_DELAY': 4.0,  # seconds; also the delay used until enough samples are collected
+    'BUDGET_RATIO': float(os.environ.get('CHAT_HEDGING_BUDGET', '0.1')),  # hedges earned per request
+    'BUDGET_BURST': 3,
+    'HOLDOUT_RATE': 0.05,  # fraction of calls never hedged, used as the p99 baseline
+}
+# When set, every streamed agent run is recorded to a cassette in this directory
+# (see chat/cassettes.py and `manage.py replay_cassette`).
+CHAT_CASSETTE_DIR = os.environ.get('CHAT_CASSETTE_DIR') or None
+# Image requests: stream the vision tool's own completion to the SSE client, and/or
+# use the tool output as the detector's final answer instead of having it restated.
+# Streaming implies the final-output behaviour, otherwise the answer would be sent twice.
+CHAT_IMAGE_TOOL_STREAMING = os.environ.get('CHAT_IMAGE_TOOL_STREAMING', 'False').lower() == 'true'
+CHAT_IMAGE_TOOL_OUTPUT_FINAL = os.environ.get('CHAT_IMAGE_TOOL_OUTPUT_FINAL', 'False').lower() == 'true'
+# Image uploads: several photos per turn are allowed. They are sent to the vision model in
+# one request while their base64 payload fits CHAT_IMAGE_BATCH_MAX_BYTES, otherwise
+# analyzed one per request with at most CHAT_IMAGE_ANALYSIS_CONCURRENCY in flight, and the
+# findings combined by one more text-only request.
+CHAT_MAX_IMAGES_PER_TURN = int(os.environ.get('CHAT_MAX_IMAGES_PER_TURN', '4'))
+CHAT_MAX_IMAGE_BYTES = 10 * 1024 * 1024
+CHAT_MAX_TOTAL_IMAGE_BYTES = 20 * 1024 * 1024
+CHAT_IMAGE_BATCH_MAX_BYTES = 8 * 1024 * 1024
+CHAT_IMAGE_ANALYSIS_CONCURRENCY = int(os.environ.get('CHAT_IMAGE_ANALYSIS_CONCURRENCY', '3'))
+# Upstream conversation continuation (see chat/continuation.py): later turns send only the
+# new message plus the previous response id. Handles live in the default cache, which is
+# per-process LocMemCache unless CACHES is configured; a miss just means a full resend.
+CHAT_CONTINUATION = {
+    'ENABLED': os.environ.get('CHAT_CONTINUATION', 'False').lower() == 'true',
+    'TTL': int(os.environ.get('CHAT_CONTINUATION_TTL', '3600')),  # seconds
+}
+# WebSocket chat (ws://<host>/multiagent/ws/, served by realestateassistant.asgi): number of
+# outgoing frames buffered per connection before the agent stream waits for the client.
+CHAT_WEBSOCKET_OUTBOX_SIZE = 64
+# Seconds a streamed agent run keeps going after its SSE/WebSocket client disconnects before
+# it is cancelled (see chat/cancellation.py); a run that completes within it is saved as if it
+# had been delivered. 0 cancels immediately. Disconnects are only
+# noticed under ASGI; WSGI workers buffer the whole async stream before sending it.
+CHAT_DISCONNECT_GRACE_SECONDS = float(os.environ.get('CHAT_DISCONNECT_GRACE_SECONDS', '0'))
+# Logging. LOG_MODE "structured" (default) writes JSON lines from a background thread
+# (started per process on the first record, so it survives a pre-fork) through a
+# bounded queue so request threads never block on the console; "console" is
+# the plain synchronous text handler. CHAT_LOG_LEVEL sets the level for the chat app,
+# and CHAT_LOG_DELTA_SAMPLE_RATE the fraction of per-delta DEBUG records that are kept.
+LOG_MODE = os.environ.get('LOG_MODE', 'structured')
+CHAT_LOG_LEVEL = os.environ.get('CHAT_LOG_LEVEL', 'INFO').upper()
+CHAT_LOG_DELTA_SAMPLE_RATE = float(os.environ.get('CHAT_LOG_DELTA_SAMPLE_RATE', '0.01'))
+_LOG_HANDLERS = {
+    'structured': {
+        'class': 'chat.log.QueueStreamHandler',
+        'formatter': 'json',
+        'maxsize': 10000,
+    },
+    'console': {
+        'class': 'logging.StreamHandler',
+        'formatter': 'text',
+    },
+}
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
-    'handlers': {
-        'console': {
-            'class': 'logging.StreamHandler',
+    'formatters': {
+        'json': {
+            '()': 'chat.log.JsonFormatter',
         },
+        'text': {
+            'format': '%(asctime)s %(levelname)s [%(name)s] %(message)s',
+        },
+    },
+    'handlers': {
+        # Only the selected handler is built, so console mode starts no listener thread
+        'default': _LOG_HANDLERS.get(LOG_MODE, _LOG_HANDLERS['console']),
     },
     'root': {
-        'handlers': ['console'],
+        'handlers': ['default'],
         'level': 'INFO',  # Set the root logger level to INFO (or DEBUG for more detailed logs)
     },
-}
\ No newline at end of file
+    'loggers': {
+        'chat': {
+            'level': CHAT_LOG_LEVEL,
+        },
+    },
+}
@@ -47,42 +47,48 @@ interface Message {
   id: number | string;
   text: string;
   sender: 'user' | 'agent';
-  image?: string;
+  images?: string[];
   isStreaming?: boolean;
   agentName?: string; // This will store the name like "Property Issue Detector"
 }
 const API_BASE_URL = import.meta.env.VITE_API_BASE_URL || '/api/';
 
 const API_STREAM_URL = `${API_BASE_URL}multiagent/stream/`;
+// Matches the backend's CHAT_MAX_IMAGES_PER_TURN default
+const MAX_IMAGES_PER_MESSAGE = 4;
 const ChatStreamInterface: React.FC = () => {
   const [messages, setMessages] = useState<Message[]>([]);
   const [inputText, setInputText] = useState('');
-  const [selectedImage, setSelectedImage] = useState<File | null>(null);
-  const [imagePreview, setImagePreview] = useState<string | null>(null);
+  const [selectedImages, setSelectedImages] = useState<File[]>([]);
+  const [imagePreviews, setImagePreviews] = useState<string[]>([]);
   const [isLoading, setIsLoading] = useState(false);
   // State holds the *found* agent object (with colors etc.) or null
   const [activeAgent, setActiveAgent] = useState<typeof AGENTS[0] | null>(null); // Correct type
 
   const fileInputRef = useRef<HTMLInputElement>(null);
   const messagesEndRef = useRef<HTMLDivElement>(null);
+  // Server-issued id that lets the backend continue the conversation upstream
+  const conversationIdRef = useRef<string | null>(null);
 
   useEffect(() => {
     messagesEndRef.current?.scrollIntoView({ behavior: 'smooth' });
   }, [messages]);
 
   useEffect(() => {
-    if (selectedImage) {
+    let cancelled = false;
+    Promise.all(selectedImages.map(file => new Promise<string>(resolve => {
       const reader = new FileReader();
-      reader.onloadend = () => setImagePreview(reader.result as string);
-      reader.readAsDataURL(selectedImage);
-    } else {
-      setImagePreview(null);
-    }
-  }, [selectedImage]);
+      reader.onloadend = () => resolve(reader.result as string);
+      reader.readAsDataURL(file);
+    }))).then(previews => {
+      if (!cancelled) setImagePreviews(previews);
+    });
+    return () => { cancelled = true; };
+  }, [selectedImages]);
 
   const handleSendMessage = async () => {
     const textToSend = inputText.trim();
-    if (!textToSend && !selectedImage) return;
+    if (!textToSend && selectedImages.length === 0) return;
 
     // --- Prepare history ---
     const historyToSend: HistoryItem[] = messages
@@ -100,13 +106,13 @@ const ChatStreamInterface: React.FC = () => {
       id: userMsgId,
       text: textToSend,
       sender: 'user',
-      image: imagePreview || undefined,
+      images: imagePreviews.length ? imagePreviews : undefined,
     };
     setMessages(prev => [...prev, userMsg]);
     setInputText('');
-    const imageToSend = selectedImage; // Keep a reference
-    setSelectedImage(null);
-    setImagePreview(null);
+    const imagesToSend = selectedImages; // Keep a reference
+    setSelectedImages([]);
+    setImagePreviews([]);
     if (fileInputRef.current) fileInputRef.current.value = '';
 
     setIsLoading(true);
@@ -128,11 +134,14 @@ const ChatStreamInterface: React.FC = () => {
     // --- Prepare FormData ---
     const formData = new FormData();
     formData.append('text', textToSend); // Current user text
-    if (imageToSend) {
-        formData.append('image', imageToSend); // Current user image
-    }
+    imagesToSend.forEach(file => {
+        formData.append('image', file); // Current user images, one field each
+    });
     // Add history as a JSON string
     formData.append('history', JSON.stringify(historyToSend));
+    if (conversationIdRef.current) {
+        formData.append('conversation_id', conversationIdRef.current);
+    }
 
     let eventSource: EventSource | null = null; // Using EventSource for cleaner SSE handling
 
@@ -182,6 +191,10 @@ const ChatStreamInterface: React.FC = () => {
                             const jsonData = event.substring(6);
                             const data = JSON.parse(jsonData);
 
+                            if (data.conversation_id) {
+                                conversationIdRef.current = data.conversation_id;
+                            }
+
                             // --- Agent Name Handling (No changes needed here) ---
                             if (data.agent && !agentNameFromServer) {
                                 agentNameFromServer = data.agent;
@@ -253,8 +266,8 @@ const ChatStreamInterface: React.FC = () => {
     } finally {
         setIsLoading(false);
         // Clear selections again just in case something failed mid-process
-        setSelectedImage(null);
-        setImagePreview(null);
+        setSelectedImages([]);
+        setImagePreviews([]);
         if (fileInputRef.current) fileInputRef.current.value = '';
         // Reset active agent display if stream ends or errors out
          // setActiveAgent(null); // Keep the last active agent displayed? Or clear? User choice. Let's keep it displayed.
@@ -272,14 +285,15 @@ const ChatStreamInterface: React.FC = () => {
   };
   const handleImageUploadClick = () => fileInputRef.current?.click();
   const handleFileChange = (e: React.ChangeEvent<HTMLInputElement>) => {
-    if (e.target.files?.[0]) {
-      setSelectedImage(e.target.files[0]);
+    const files = Array.from(e.target.files ?? []);
+    if (files.length) {
+      setSelectedImages(prev => [...prev, ...files].slice(0, MAX_IMAGES_PER_MESSAGE));
     }
+    // Reset so picking the same file again still fires onChange
+    e.target.value = '';
   };
-  const removeSelectedImage = () => {
-    setSelectedImage(null);
-    setImagePreview(null);
-    if (fileInputRef.current) fileInputRef.current.value = '';
+  const removeSelectedImage = (index: number) => {
+    setSelectedImages(prev => prev.filter((_, i) => i !== index));
   };
 
   // --- Main Render (Mostly Unchanged, check message styling logic) ---
@@ -330,9 +344,9 @@ const ChatStreamInterface: React.FC = () => {
                   ${msg.isStreaming ? 'opacity-90' : ''}      // Subtle opacity for streaming
                   transition-opacity duration-300            // Smooth transition when streaming stops
                 `}>
-                  {msg.image && (
-                    <img src={msg.image} alt="User upload" className="max-w-xs max-h-48 rounded mb-2 border" />
-                  )}
+                  {msg.images?.map((src, index) => (
+                    <img key={index} src={src} alt={`User upload ${index + 1}`} className="max-w-xs max-h-48 rounded mb-2 border" />
+                  ))}
                   {msg.sender === 'agent' ? (
                     <div className="prose prose-sm max-w-none"> {/* Use prose-sm for smaller text, max-w-none */}
                       <ReactMarkdown
@@ -364,16 +378,20 @@ const ChatStreamInterface: React.FC = () => {
         {/* Input Area (Unchanged) */}
         <div className="p-4 border-t bg-gray-50">
            {/* Image Preview (Unchanged) */}
-          {imagePreview && (
-            <div className="mb-2 relative w-24 h-24 border rounded p-1 bg-white">
-              <img src={imagePreview} alt="Selected preview" className="w-full h-full object-cover rounded" />
-              <button
-                onClick={removeSelectedImage}
-                className="absolute top-0 right-0 -mt-2 -mr-2 bg-red-500 text-white rounded-full p-0.5 shadow-md hover:bg-red-600 focus:outline-none focus:ring-2 focus:ring-red-400 focus:ring-offset-1"
-                aria-label="Remove image"
-              >
-                <X size={14} strokeWidth={3}/>
-              </button>
+          {imagePreviews.length > 0 && (
+            <div className="mb-2 flex gap-3">
+              {imagePreviews.map((preview, index) => (
+                <div key={index} className="relative w-24 h-24 border rounded p-1 bg-white">
+                  <img src={preview} alt={`Selected preview ${index + 1}`} className="w-full h-full object-cover rounded" />
+                  <button
+                    onClick={() => removeSelectedImage(index)}
+                    className="absolute top-0 right-0 -mt-2 -mr-2 bg-red-500 text-white rounded-full p-0.5 shadow-md hover:bg-red-600 focus:outline-none focus:ring-2 focus:ring-red-400 focus:ring-offset-1"
+                    aria-label={`Remove image ${index + 1}`}
+                  >
+                    <X size={14} strokeWidth={3}/>
+                  </button>
+                </div>
+              ))}
             </div>
           )}
            {/* Input Row (Unchanged) */}
@@ -383,6 +401,7 @@ const ChatStreamInterface: React.FC = () => {
               ref={fileInputRef}
               onChange={handleFileChange}
               accept="image/*"
+              multiple
               className="hidden"
             />
             <button
@@ -391,7 +410,7 @@ const ChatStreamInterface: React.FC = () => {
               aria-label="Attach image"
               tabIndex={-1}
               type="button"
-              disabled={isLoading}
+              disabled={isLoading || selectedImages.length >= MAX_IMAGES_PER_MESSAGE}
             >
               <ImageIcon size={20} />
             </button>
@@ -407,9 +426,9 @@ const ChatStreamInterface: React.FC = () => {
             />
             <button
               onClick={handleSendMessage}
-              disabled={(!inputText.trim() && !selectedImage) || isLoading}
+              disabled={(!inputText.trim() && selectedImages.length === 0) || isLoading}
               className={`p-2 rounded-md text-white ${
-                isLoading || (!inputText.trim() && !selectedImage)
+                isLoading || (!inputText.trim() && selectedImages.length === 0)
                   ? 'bg-gray-400 cursor-not-allowed'
                   : 'bg-blue-500 hover:bg-blue-600 focus:outline-none focus:ring-2 focus:ring-blue-400 focus:ring-offset-1'
               } transition-colors duration-200 ml-2`}